@@ -1,15 +1,31 @@
 import io
+import os
 from datetime import datetime
+from functools import lru_cache
 from typing import Tuple, Optional
 
-from PIL import Image, ImageOps, UnidentifiedImageError
+import numpy as np
+from scipy import ndimage
+from PIL import Image, ImageOps, UnidentifiedImageError, features
 from flask import Flask, request, send_file, abort, jsonify
 from flask_cors import CORS
+from werkzeug.exceptions import RequestEntityTooLarge
 
 # =========================
 # Config & Constantes
 # =========================
 MAX_UPLOAD_MB = 10  # límite de subida (Render tiene su propio límite también)
+# Lado máximo al decodificar JPEG (reducción 1/2, 1/4, 1/8 de libjpeg); 0 = sin límite
+# Desactivado por defecto: cambia las dimensiones de salida (se avisa con X-Downscaled-From)
+MAX_EDGE = int(os.environ.get("MAX_EDGE", "0"))
+# Tope de píxeles tras decodificar (los bytes ya los limita MAX_UPLOAD_MB); 0 = sin límite
+# Presupuesto de RAM: un request con remove_bg usa ~18 B/píxel (≈450 MB con 25 MP) y cada
+# worker arranca en ~70 MB → total ≈ WEB_CONCURRENCY × (70 MB + GUNICORN_THREADS × 18 B × MAX_PIXELS).
+# Con los valores del procfile (2×2) y 25 MP: ~2 GB; en instancias chicas bajar threads o MAX_PIXELS.
+MAX_PIXELS = int(os.environ.get("MAX_PIXELS", "25000000"))
+PNG_DEFAULT_LEVEL = 1
+# Claves de img.info con metadatos que la recodificación descarta (EXIF/GPS, XMP, ICC, IPTC, comentarios)
+METADATA_KEYS = ("exif", "xmp", "XML:com.adobe.xmp", "icc_profile", "photoshop", "comment")  # zlib rápido; ?optimize=1 vuelve a la compresión máxima
 
 # Formatos de salida soportados -> (PIL_SAVE_FORMAT, MIME)
 TARGETS = {
@@ -21,6 +37,13 @@ TARGETS = {
     "tiff": ("TIFF", "image/tiff"),
 }
 
+# Codecs que Pillow necesita para los formatos anunciados. pillow-simd se compila
+# desde fuente: si faltaban las cabeceras en el build, el codec no existe → no arrancar
+REQUIRED_CODECS = ("jpg", "zlib", "webp", "libtiff")
+_missing_codecs = [c for c in REQUIRED_CODECS if not features.check(c)]
+if _missing_codecs:
+    raise RuntimeError(f"Pillow compilado sin soporte para: {', '.join(_missing_codecs)}")
+
 # Formatos de entrada aceptados (Pillow abre muchos; listamos los comunes)
 ACCEPTED_INPUT_EXTS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff", ".gif"}
 
@@ -29,10 +52,13 @@ ALLOWED_ORIGINS = [
     "https://www.zetaconvert.online",
 ]
 
+# Pillow corta las "decompression bombs" al abrir (error a partir de 2x este valor)
+Image.MAX_IMAGE_PIXELS = MAX_PIXELS or None
+
 app = Flask(__name__)
 app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_MB * 1024 * 1024
 # CORS sólo para /convert (GET para health queda abierto)
-CORS(app, resources={r"/convert": {"origins": ALLOWED_ORIGINS}})
+CORS(app, resources={r"/convert": {"origins": ALLOWED_ORIGINS, "expose_headers": ["X-Converted-To", "X-Downscaled-From"]}})
 
 # =========================
 # Helpers base
@@ -50,7 +76,11 @@ def handle_404(e): return error_response(404, "Not Found")
 def handle_405(e): return error_response(405, "Method Not Allowed")
 
 @app.errorhandler(413)
-def handle_413(e): return error_response(413, f"Archivo excede el límite ({MAX_UPLOAD_MB} MB)")
+def handle_413(e):
+    # abort(413, msg) propio (p.ej. demasiados píxeles) vs. límite de subida de Flask
+    if getattr(e, "description", None) not in (None, RequestEntityTooLarge.description):
+        return error_response(413, e.description)
+    return error_response(413, f"Archivo excede el límite ({MAX_UPLOAD_MB} MB)")
 
 @app.errorhandler(415)
 def handle_415(e): return error_response(415, getattr(e, "description", "Unsupported Media Type"))
@@ -58,6 +88,21 @@ def handle_415(e): return error_response(415, getattr(e, "description", "Unsuppo
 @app.errorhandler(500)
 def handle_500(e): return error_response(500, "Error interno")
 
+def send_download(data: bytes, mime: str, name: str):
+    """Descarga sin ETag ni respuestas condicionales (evita recorrer el buffer de nuevo)."""
+    # Nota: max_age=0 evita cache agresivo de proxies
+    return send_file(
+        io.BytesIO(data),
+        mimetype=mime,
+        as_attachment=True,
+        download_name=name,
+        max_age=0,
+        etag=False,
+        last_modified=None,
+        conditional=False,
+    )
+
+@lru_cache(maxsize=64)
 def pick_target(raw: str) -> Tuple[str, str]:
     """Valida el target y devuelve (pil_format, mime)."""
     key = (raw or "").lower().strip().lstrip(".")
@@ -73,6 +118,10 @@ def safe_first_frame(im: Image.Image) -> Image.Image:
             im.seek(0)
     except Exception:
         pass
+    # Sin orientación EXIF (o =1) exif_transpose sólo haría una copia completa
+    if im.getexif().get(0x0112, 1) == 1:
+        im.load()  # decodificar acá: errores de archivo corrupto → 400 en convert()
+        return im
     return ImageOps.exif_transpose(im)
 
 def prepare_modes(img: Image.Image, pil_fmt: str) -> Image.Image:
@@ -80,105 +129,112 @@ def prepare_modes(img: Image.Image, pil_fmt: str) -> Image.Image:
     if pil_fmt == "JPEG":
         # JPEG no soporta alpha → convertir a RGB con fondo blanco si hace falta
         if img.mode in ("RGBA", "LA") or ("transparency" in img.info):
-            bg = Image.new("RGB", img.size, (255, 255, 255))
+            bg = Image.new("RGBA", img.size, (255, 255, 255, 255))
             if img.mode != "RGBA":
                 img = img.convert("RGBA")
-            bg.paste(img, mask=img.split()[-1])
-            return bg
+            return Image.alpha_composite(bg, img).convert("RGB")
         return img.convert("RGB")
     # Para los demás, preservamos alpha si existe
     if img.mode not in ("RGB", "RGBA"):
         return img.convert("RGBA")
     return img
 
+def is_opaque(img: Image.Image) -> bool:
+    """True si la imagen (RGB/RGBA, ya pasada por prepare_modes) no tiene ningún píxel transparente."""
+    if "transparency" in img.info:
+        return False
+    if img.mode == "RGB":
+        return True
+    if img.mode == "RGBA":
+        return img.getchannel("A").getextrema() == (255, 255)
+    return False
+
+def has_metadata(img: Image.Image) -> bool:
+    """True si la imagen trae metadatos que no deben devolverse tal cual."""
+    if img.format == "TIFF":
+        return True  # los tags (incl. GPS) viven en el IFD, no en info
+    if any(k in img.info for k in METADATA_KEYS):
+        return True
+    # Textos PNG (tEXt/iTXt/zTXt): `text` decodifica, así que sólo si ya está cargada
+    return img.format == "PNG" and img.im is not None and bool(img.text)
+
 # =========================
 # Remove background (sin IA)
 # =========================
-def hex_to_rgb(h: Optional[str]):
-    h = (h or "").strip().lstrip("#")
+@lru_cache(maxsize=64)
+def _hex_to_rgb_cached(h: str) -> Tuple[int, int, int]:
+    h = h.strip().lstrip("#")
     if len(h) == 3:
         h = "".join([c * 2 for c in h])  # #abc -> #aabbcc
     if len(h) != 6:
-        abort(400, "Color inválido; usar #RRGGBB")
+        raise ValueError(h)
     return tuple(int(h[i:i + 2], 16) for i in (0, 2, 4))
 
-def color_dist(c, ref):
-    # Distancia Manhattan
-    return abs(c[0] - ref[0]) + abs(c[1] - ref[1]) + abs(c[2] - ref[2])
+def hex_to_rgb(h: Optional[str]):
+    # La validación falla con ValueError; el abort queda fuera de la función cacheada
+    try:
+        return _hex_to_rgb_cached(h or "")
+    except ValueError:
+        abort(400, "Color inválido; usar #RRGGBB")
 
-def avg_border_color(img: Image.Image):
-    if img.mode not in ("RGB", "RGBA"):
-        img = img.convert("RGBA")
-    px = img.load()
+def color_dist(arr: np.ndarray, ref) -> np.ndarray:
+    # Distancia Manhattan por píxel, canal a canal sobre un único buffer int16
+    # (máx. 3*255; evita copias HxWx3 y la suma en int64)
+    dist = np.zeros(arr.shape[:-1], dtype=np.int16)
+    tmp = np.empty_like(dist)
+    for c in range(3):
+        np.subtract(arr[..., c], int(ref[c]), out=tmp, dtype=np.int16)
+        np.abs(tmp, out=tmp)
+        dist += tmp
+    return dist
+
+def border_pixels(img: Image.Image) -> np.ndarray:
+    """Píxeles RGB del borde como array (N, 3); las esquinas aparecen dos veces."""
+    # Sólo se copian/convierten tiras de 1 px, no la imagen entera
     w, h = img.size
-    total = [0, 0, 0]; count = 0
-    for x in range(w):
-        for y in (0, h - 1):
-            r, g, b = px[x, y][:3]
-            total[0] += r; total[1] += g; total[2] += b; count += 1
-    for y in range(h):
-        for x in (0, w - 1):
-            r, g, b = px[x, y][:3]
-            total[0] += r; total[1] += g; total[2] += b; count += 1
-    return (total[0] // count, total[1] // count, total[2] // count)
+    boxes = ((0, 0, w, 1), (0, h - 1, w, h), (0, 0, 1, h), (w - 1, 0, w, h))
+    return np.concatenate([np.asarray(img.crop(b).convert("RGB")).reshape(-1, 3) for b in boxes])
+
+def avg_border_color(border: np.ndarray):
+    """Color promedio de los píxeles de borde (salida de border_pixels)."""
+    return tuple(int(v) for v in border.mean(axis=0))
 
 def remove_bg_floodfill(img: Image.Image, tolerance=30, ref_color=None):
     """
     Hace transparente lo conectado al BORDE con color similar al de referencia.
     - ref_color: (R,G,B) o None → usa promedio del borde
     - tolerance: 0..100 (mapea a umbral ~0..210)
+    Si img ya es RGBA, su alpha se modifica en el lugar.
     """
     tol = max(0, min(100, int(tolerance)))
     thr = int(2.1 * tol)
 
     if img.mode != "RGBA":
         img = img.convert("RGBA")
-    w, h = img.size
-    px = img.load()
 
+    border = border_pixels(img)
     if ref_color is None:
-        ref_color = avg_border_color(img)
-
-    visited = [[False] * w for _ in range(h)]
-    make_transp = [[False] * w for _ in range(h)]
-
-    from collections import deque
-    q = deque()
-
-    def try_push(x, y):
-        if 0 <= x < w and 0 <= y < h and not visited[y][x]:
-            r, g, b, a = px[x, y]
-            if color_dist((r, g, b), ref_color) <= thr:
-                visited[y][x] = True
-                make_transp[y][x] = True
-                q.append((x, y))
-
-    # bordes como semillas
-    for x in range(w):
-        try_push(x, 0); try_push(x, h - 1)
-    for y in range(h):
-        try_push(0, y); try_push(w - 1, y)
-
-    # flood-fill 4-conexo
-    while q:
-        x, y = q.popleft()
-        for nx, ny in ((x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)):
-            if 0 <= nx < w and 0 <= ny < h and not visited[ny][nx]:
-                r, g, b, a = px[nx, ny]
-                if color_dist((r, g, b), ref_color) <= thr:
-                    visited[ny][nx] = True
-                    make_transp[ny][nx] = True
-                    q.append((nx, ny))
-                else:
-                    visited[ny][nx] = True
-
-    out = Image.new("RGBA", (w, h))
-    dst = out.load()
-    for y in range(h):
-        for x in range(w):
-            r, g, b, a = px[x, y]
-            dst[x, y] = (r, g, b, 0) if make_transp[y][x] else (r, g, b, a)
-    return out
+        ref_color = avg_border_color(border)
+
+    # Sin semillas en el borde no hay fondo que quitar: evita la pasada completa
+    if not (color_dist(border, ref_color) <= thr).any():
+        return img
+
+    arr = np.asarray(img)
+    similar = color_dist(arr, ref_color) <= thr
+
+    # Componentes 4-conexas de píxeles similares; se quedan las que tocan el borde
+    labels, n = ndimage.label(similar)
+    keep = np.zeros(n + 1, dtype=bool)
+    keep[labels[0, :]] = keep[labels[-1, :]] = True
+    keep[labels[:, 0]] = keep[labels[:, -1]] = True
+    keep[0] = False  # etiqueta 0 = no similar
+    make_transp = keep[labels]
+
+    # Sólo se reemplaza el canal alpha (alpha=0 donde hay fondo)
+    alpha = np.where(make_transp, 0, arr[..., 3]).astype(np.uint8, copy=False)
+    img.putalpha(Image.fromarray(alpha))
+    return img
 
 def ext_of(name: str) -> str:
     name = (name or "").lower().strip()
@@ -223,16 +279,69 @@ def convert():
     mode = (request.form.get("remove_bg_mode") or "auto").lower()  # "auto" | "color"
     ref_hex = request.form.get("ref_color")  # "#RRGGBB" si modo color
 
+    # Opciones de codificación PNG
+    optimize = (request.form.get("optimize") == "1") or (request.args.get("optimize") == "1")
+    png_level_raw = request.form.get("png_level") or request.args.get("png_level")
+    try:
+        png_level = max(0, min(9, int(png_level_raw or PNG_DEFAULT_LEVEL)))
+    except ValueError:
+        abort(400, "png_level inválido; usar 0..9")
+    # PNG sin transparencia → JPEG (más rápido y liviano), sólo si el cliente lo pide
+    auto_format = (request.form.get("auto_format") == "1") or (request.args.get("auto_format") == "1")
+
     pil_fmt, out_mime = pick_target(target_raw)
+    out_key = target_raw.lower().strip().lstrip(".")
+    converted_to = None
+    downscaled_from = None
+    base = f.filename.rsplit(".", 1)[0] or "convertido"
 
     try:
         img = Image.open(f.stream)
-        img = safe_first_frame(img)
+        drafting = bool(MAX_EDGE) and img.format == "JPEG" and max(img.size) > MAX_EDGE
+        # Mismo formato y nada que cambie la imagen → devolver los bytes originales.
+        # Sin EXIF tampoco hay orientación que aplicar.
+        passthrough = (
+            img.format == pil_fmt
+            and not remove_bg
+            and not (pil_fmt == "PNG" and (optimize or png_level_raw or auto_format))
+            and not drafting
+            and img.mode != "CMYK"
+            and not getattr(img, "is_animated", False)
+            and not has_metadata(img)
+        )
+        if drafting:
+            # draft() sólo reduce si ambos lados caben: pedir la caja con la misma proporción
+            scale = MAX_EDGE / max(img.size)
+            original_size = img.size
+            img.draft(img.mode, (max(1, int(img.width * scale)), max(1, int(img.height * scale))))
+            if img.size != original_size:
+                downscaled_from = f"{original_size[0]}x{original_size[1]}"
     except UnidentifiedImageError:
         abort(400, "El archivo no parece ser una imagen válida")
+    except Image.DecompressionBombError:
+        abort(413, f"Imagen demasiado grande (máx. {MAX_PIXELS} píxeles)")
+    except Exception:
+        abort(400, "No se pudo abrir la imagen")
+
+    # Antes de decodificar: el costo de todo lo que sigue escala con los píxeles
+    if MAX_PIXELS and img.width * img.height > MAX_PIXELS:
+        abort(413, f"Imagen demasiado grande (máx. {MAX_PIXELS} píxeles)")
+
+    try:
+        if passthrough:
+            img.load()  # valida: un archivo corrupto no se devuelve con 200
+            # PNG: los textos sólo se ven decodificada (y puede haber chunks tras los datos)
+            passthrough = not has_metadata(img)
+        if not passthrough:
+            img = safe_first_frame(img)
     except Exception:
         abort(400, "No se pudo abrir la imagen")
 
+    if passthrough:
+        # El stream de subida se cierra al terminar el request: copiar los bytes
+        f.stream.seek(0)
+        return send_download(f.stream.read(), out_mime, f"{base}.{out_key}")
+
     if remove_bg and pil_fmt != "PNG":
         abort(400, "La opción 'eliminar fondo' sólo funciona al convertir a PNG")
 
@@ -245,42 +354,46 @@ def convert():
         if mode == "color":
             ref = hex_to_rgb(ref_hex)
         img = remove_bg_floodfill(img, tolerance=tolerance, ref_color=ref)
+    elif auto_format and pil_fmt == "PNG" and is_opaque(img):
+        out_key = converted_to = "jpg"
+        pil_fmt, out_mime = TARGETS[out_key]
+        # Ya se sabe opaca: basta descartar el alpha, sin componer sobre blanco
+        if img.mode != "RGB":
+            img = img.convert("RGB")
 
     # Serializar a buffer
-    buf = io.BytesIO()
     save_kwargs = {}
     if pil_fmt == "PNG":
-        save_kwargs.update(optimize=True)
+        if optimize:
+            save_kwargs.update(optimize=True)
+        else:
+            save_kwargs.update(compress_level=png_level)
     elif pil_fmt == "JPEG":
         save_kwargs.update(quality=90, optimize=True, progressive=True)
     elif pil_fmt == "WEBP":
         save_kwargs.update(quality=90, method=6)
 
     try:
-        img.save(buf, format=pil_fmt, **save_kwargs)
+        with io.BytesIO() as buf:
+            img.save(buf, format=pil_fmt, **save_kwargs)
+            data = buf.getvalue()
     except Exception:
         abort(500, "No se pudo convertir la imagen al formato solicitado")
 
-    buf.seek(0)
-    base = f.filename.rsplit(".", 1)[0] or "convertido"
-    out_ext = "." + (target_raw.lower().lstrip("."))
+    out_ext = "." + out_key
     out_name = f"{base}{out_ext}"
 
-    # Nota: max_age=0 evita cache agresivo de proxies
-    return send_file(
-        buf,
-        mimetype=out_mime,
-        as_attachment=True,
-        download_name=out_name,
-        max_age=0,
-        etag=False,
-        last_modified=None,
-        conditional=False,
-    )
+    resp = send_download(data, out_mime, out_name)
+    if converted_to:
+        resp.headers["X-Converted-To"] = converted_to
+    if downscaled_from:
+        resp.headers["X-Downscaled-From"] = downscaled_from
+    return resp
 
 # =========================
 # Main (local)
 # =========================
 if __name__ == "__main__":
-    # Para correr local: python app.py
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    # Para correr local: python app.py (FLASK_DEBUG=1 activa reloader/debugger)
+    debug = os.environ.get("FLASK_DEBUG", "").lower() in ("1", "true")
+    app.run(host="0.0.0.0", port=5000, debug=debug)